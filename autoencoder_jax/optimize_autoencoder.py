@@ -40,7 +40,8 @@ def objective(trial, train_dataset, test_dataset, rng):
         encoder_features=encoder_features,
         decoder_features=decoder_features,
         dropout_rate=dropout_rate,
-        activation_name=activation_function
+        activation_name=activation_function,
+        dtype=ae.default_compute_dtype()
     )
     
     # Train model (without saving)
@@ -65,6 +66,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     grid_dir, grid_name = sys.argv[1], sys.argv[2]
+    ae.enable_compilation_cache()
     
     # Load data
     N_samples = int(1e4)
@@ -90,7 +92,8 @@ if __name__ == "__main__":
         encoder_features=best_encoder_features,
         decoder_features=best_encoder_features[::-1],
         dropout_rate=best_params['dropout_rate'],
-        activation_name=best_params['activation_function']
+        activation_name=best_params['activation_function'],
+        dtype=ae.default_compute_dtype()
     )
 
     # Train the final model with the best hyperparameters
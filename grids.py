@@ -1,5 +1,8 @@
+from functools import lru_cache
+
 import h5py
 from scipy.stats import qmc
+import jax
 import jax.numpy as jnp
 import numpy as np
 
@@ -72,8 +75,18 @@ from unyt import Msun, yr, angstrom
 #         return self.conditions[idx], self.spectra[idx]
     
 
-def LHGridSpectra(grid_dir, grid_name, num_samples=1000):
+@lru_cache(maxsize=None)
+def load_grid(grid_dir, grid_name):
+    """Loads a grid once per (grid_dir, grid_name) along with the indices of
+    the wavelengths between 1000 and 10000 Angstrom."""
     grid = Grid(grid_dir=grid_dir, grid_name=grid_name, read_lines=False)
+    lam = grid.lam.to(angstrom).value
+    mask_idx = np.flatnonzero((lam > 1000) & (lam < 10000))
+    return grid, mask_idx
+
+
+def LHGridSpectra(grid_dir, grid_name, num_samples=1000, chunk_size=1000):
+    grid, mask_idx = load_grid(grid_dir, grid_name)
 
     N = num_samples
     age_lims = (np.log10(float(grid.ages.min().value)), np.log10(float(grid.ages.max().value)))
@@ -86,19 +99,24 @@ def LHGridSpectra(grid_dir, grid_name, num_samples=1000):
     samples = qmc.scale(sampler.random(n=N), (age_lims[0], met_lims[0]), (age_lims[1], met_lims[1]))
     
     initial_masses = np.ones(N) * Msun
-
-    stars = Stars(
-        initial_masses=initial_masses,
-        ages=10**samples[:, 0] * yr,
-        metallicities=samples[:, 1],
-    )
+    star_ages = 10**samples[:, 0] * yr
 
     emodel = IncidentEmission(grid, per_particle=True)
-    spec = stars.get_spectra(emodel)
 
-    mask = (grid.lam > 1000 * angstrom) & (grid.lam < 10000 * angstrom)
-    spectra = spec.lnu[:, mask]
-    wavelength = grid.lam[mask]
+    # Compute spectra in chunks of particles, keeping only the masked wavelengths,
+    # so the full-wavelength spectra never exist for more than `chunk_size` stars
+    spectra = np.empty((N, len(mask_idx)))
+    for start in range(0, N, chunk_size):
+        stop = min(start + chunk_size, N)
+        stars = Stars(
+            initial_masses=initial_masses[start:stop],
+            ages=star_ages[start:stop],
+            metallicities=samples[start:stop, 1],
+        )
+        spec = stars.get_spectra(emodel)
+        spectra[start:stop] = np.take(spec.lnu.value, mask_idx, axis=1)
+
+    wavelength = grid.lam[mask_idx]
 
     ages = samples[:, 0]
     metallicities = samples[:, 1]
@@ -106,6 +124,33 @@ def LHGridSpectra(grid_dir, grid_name, num_samples=1000):
     return spectra, wavelength, ages, metallicities
 
 
+@jax.jit
+def log_normalize_spectra(spectra):
+    """Log-transforms spectra and normalizes each wavelength bin to zero mean
+    and unit variance in a single fused XLA computation.
+
+    Returns the normalized spectra and the per-bin mean and std of the log spectra.
+    """
+    log_spectra = jnp.log10(spectra)
+    spec_mean = log_spectra.mean(axis=0)
+    spec_std = log_spectra.std(axis=0)
+    return (log_spectra - spec_mean) / spec_std, spec_mean, spec_std
+
+
+@jax.jit
+def quantize_spectra(spectra):
+    """Symmetrically quantizes normalized spectra to int8 with a per-wavelength scale.
+
+    The spectra are recovered (approximately) as `spectra_q * scale`. Also
+    returns the mean squared rounding error of that reconstruction, which is
+    the loss floor for a model trained on the quantized spectra.
+    """
+    scale = jnp.maximum(jnp.abs(spectra).max(axis=0), 1e-6) / 127.0
+    spectra_q = jnp.round(spectra / scale).astype(jnp.int8)
+    quantization_mse = jnp.mean((spectra_q * scale - spectra) ** 2)
+    return spectra_q, scale, quantization_mse
+
+
 class SpectralDatasetSynthesizer:
     def __init__(self, grid_dir=None, grid_name=None, num_samples=1000, parent_dataset=None, split=None):
 
@@ -143,16 +188,10 @@ class SpectralDatasetSynthesizer:
             # Create conditions from normalized parameters
             self.conditions = jnp.stack([norm_ages, norm_mets]).T
 
-            # Reshape and log-transform spectra
+            # Reshape, log-transform and normalize spectra, storing the
+            # normalization parameters
             self.spectra = self.spectra.reshape(-1, self.n_wavelength)
-            self.spectra = jnp.log10(self.spectra)
-
-            # Calculate and store normalization parameters for spectra
-            self.spec_mean = self.spectra.mean(axis=0)
-            self.spec_std = self.spectra.std(axis=0)
-            
-            # Normalize spectra
-            self.spectra = (self.spectra - self.spec_mean) / self.spec_std
+            self.spectra, self.spec_mean, self.spec_std = log_normalize_spectra(self.spectra)
 
         if split is not None:
             # Apply the split to all relevant arrays